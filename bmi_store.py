@@ -0,0 +1,265 @@
+'''
+On-disk array store for the BMI data set and a chunked input pipeline
+
+The store is a directory with one uncompressed .npy file per (key, fold) pair
+(e.g., MI_03.npy, time_03.npy, torque_03.npy) and a small JSON manifest.  Opening
+the store memory maps the files, so it has the same structure as the pickled data set
+(dictionary of lists of per-fold arrays) without reading them into memory.
+
+Streamed training reads the training folds in chunks of rows.  When shuffling, each
+chunk (the shuffle buffer) is filled with BLOCKS_PER_CHUNK blocks of rows taken from
+random places in random folds, and its rows are then shuffled in memory, so each
+minibatch mixes several folds and time periods.  The next chunk is read by a
+background thread while the current one is being trained on.  Peak memory is set by
+the chunk size, not by the size of the data set.
+
+Convert a pickled data set with:
+python bmi_store.py --dataset bmi_dataset.pkl --store bmi_store
+
+Readers of results files (see results_io) use open_dataset_store(), which converts a
+pickled data set to a store next to it (<name>_store) the first time it is needed.
+
+Author: Brandon Michaud
+'''
+import argparse
+import json
+import numpy as np
+import os
+import pickle
+import queue
+import shutil
+import threading
+import tensorflow as tf
+
+from lag_features import fold_lags, lagged_inputs
+
+# Number of blocks of rows (from random folds) in each shuffle buffer
+BLOCKS_PER_CHUNK = 16
+
+
+def convert_dataset(fname, store_dir):
+    '''
+    Write a pickled BMI data set as an array store
+
+    :param fname: Pickled data set file
+    :param store_dir: Directory for the array store
+    '''
+    with open(fname, "rb") as fp:
+        bmi = pickle.load(fp)
+
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Only the per-fold arrays are stored
+    keys = [k for k, v in bmi.items() if isinstance(v, (list, tuple)) and isinstance(v[0], np.ndarray)]
+    for k in keys:
+        for i, a in enumerate(bmi[k]):
+            np.save(os.path.join(store_dir, '%s_%02d.npy' % (k, i)), a)
+
+    manifest = {'keys': keys, 'Nfolds': len(bmi[keys[0]])}
+    with open(os.path.join(store_dir, 'manifest.json'), "w") as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+def open_store(store_dir):
+    '''
+    Memory map an array store
+
+    :param store_dir: Directory containing the array store
+    :return: Dictionary of lists of per-fold (memory mapped) arrays
+    '''
+    with open(os.path.join(store_dir, 'manifest.json'), "r") as fp:
+        manifest = json.load(fp)
+
+    return {k: [np.load(os.path.join(store_dir, '%s_%02d.npy' % (k, i)), mmap_mode='r')
+                for i in range(manifest['Nfolds'])]
+            for k in manifest['keys']}
+
+
+def load_dataset(fname):
+    '''
+    Load the BMI data set from either a pickle file or an array store
+
+    The file name is recorded under the 'fname' key, so that values computed from the folds
+    can be cached across loads (see fold_cache)
+
+    :param fname: Pickle file name or array store directory
+    :return: Dictionary containing the full BMI data set
+    '''
+    if os.path.isdir(fname):
+        bmi = open_store(fname)
+    else:
+        with open(fname, "rb") as fp:
+            bmi = pickle.load(fp)
+
+    bmi['fname'] = os.path.abspath(fname)
+    return bmi
+
+
+def dataset_store_dir(fname):
+    '''
+    :param fname: Pickle file name or array store directory
+    :return: Array store directory for the data set (the store converted from a pickle is
+            kept next to it)
+    '''
+    if os.path.isdir(fname):
+        return fname
+    return '%s_store' % os.path.splitext(fname)[0]
+
+
+def open_dataset_store(fname):
+    '''
+    Memory map the array store of a data set, converting a pickled data set the first time
+
+    :param fname: Pickle file name or array store directory
+    :return: Dictionary containing the full BMI data set (memory mapped)
+    '''
+    store_dir = dataset_store_dir(fname)
+    if not os.path.exists(os.path.join(store_dir, 'manifest.json')):
+        # Convert into a private directory first, so that no reader sees a partial store
+        tmp_dir = '%s.%d.tmp' % (store_dir, os.getpid())
+        convert_dataset(fname, tmp_dir)
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # Another process converted it first
+            shutil.rmtree(tmp_dir)
+
+    return load_dataset(store_dir)
+
+
+def read_rows(source, start, stop, predict_dim=None):
+    '''
+    Read a range of rows of one fold
+
+    :param source: (inputs, outputs, windows, nlags) for the fold (see iterate_chunks())
+    :param start: First row
+    :param stop: End of the rows (exclusive)
+    :param predict_dim: Output dimension to extract (None for all)
+    :return: inputs and outputs (float32)
+    '''
+    ins, outs, windows, nlags = source
+    if windows is None:
+        x = np.asarray(ins[start:stop], dtype=np.float32)
+        y = np.asarray(outs[start:stop], dtype=np.float32)
+    else:
+        # Outputs are those of the last step of each window
+        w = windows[start:stop]
+        x = np.asarray(lagged_inputs(ins, w), dtype=np.float32)
+        y = np.asarray(outs[w + nlags - 1], dtype=np.float32)
+    if predict_dim is not None:
+        y = y[:, [predict_dim]]
+
+    return x, y
+
+
+def iterate_chunks(sources, chunk_size, predict_dim=None, shuffle=False, rng=None):
+    '''
+    Read a set of folds in chunks of rows
+
+    :param sources: List of (inputs, outputs, windows, nlags) for each fold.  Without lags,
+            windows and nlags are None and the rows of the inputs/outputs are read directly.
+            With lags, inputs is the fold's windows view and only the given windows are read
+            (see lag_features)
+    :param chunk_size: Maximum number of rows in a chunk
+    :param predict_dim: Output dimension to extract (None for all)
+    :param shuffle: Fill each chunk with BLOCKS_PER_CHUNK blocks of rows, visited in random
+            order across all folds, and shuffle the rows within each chunk
+    :param rng: Numpy random Generator (used when shuffling)
+    :return: Generator of (inputs, outputs) chunks
+    '''
+    nrows = [x.shape[0] if windows is None else len(windows) for x, _, windows, _ in sources]
+
+    if not shuffle:
+        for s, n in enumerate(nrows):
+            for i in range(0, n, chunk_size):
+                yield read_rows(sources[s], i, i + chunk_size, predict_dim)
+        return
+
+    # (source, first row) of each block
+    block_size = max(1, chunk_size // BLOCKS_PER_CHUNK)
+    blocks = [(s, i) for s, n in enumerate(nrows) for i in range(0, n, block_size)]
+    rng.shuffle(blocks)
+
+    for b in range(0, len(blocks), BLOCKS_PER_CHUNK):
+        parts = [read_rows(sources[s], i, i + block_size, predict_dim) for s, i in blocks[b:b + BLOCKS_PER_CHUNK]]
+        x = np.concatenate([x for x, _ in parts], axis=0)
+        y = np.concatenate([y for _, y in parts], axis=0)
+
+        perm = rng.permutation(x.shape[0])
+        yield x[perm], y[perm]
+
+
+def prefetch(iterable, depth=1):
+    '''
+    Produce the items of an iterable in a background thread
+
+    :param iterable: Items to produce (e.g., chunks read from disk)
+    :param depth: Number of items to read ahead
+    :return: Generator of the items
+    '''
+    q = queue.Queue(maxsize=depth)
+    done = object()
+
+    def worker():
+        try:
+            for item in iterable:
+                q.put(item)
+        except Exception as e:
+            q.put(e)
+        q.put(done)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def stream_folds(bmi, folds, args, shuffle=False):
+    '''
+    Create a streamed data set over a set of folds
+
+    :param bmi: Dictionary containing the full BMI data set (usually an open array store)
+    :param folds: Folds to stream
+    :param args: Argparse object, which contains key information, including output_type,
+            predict_dim, lags, chunk_size, batch_size
+    :param shuffle: Shuffle the examples (each pass uses a different order)
+    :return: tf.data.Dataset of (inputs, outputs) batches
+    '''
+    ins = bmi['MI']
+    outs = bmi[args.output_type]
+    n_inputs = ins[0].shape[1] * (1 if args.lags is None else args.lags)
+    n_outputs = outs[0].shape[1] if args.predict_dim is None else 1
+    rng = np.random.default_rng()
+
+    if args.lags is None:
+        sources = [(ins[f], outs[f], None, None) for f in folds]
+    else:
+        sources = [fold_lags(bmi, f, args.lags) for f in folds]
+        sources = [(view, outs[f], windows, args.lags) for f, (view, windows) in zip(folds, sources)]
+
+    def generator():
+        chunks = iterate_chunks(sources, args.chunk_size, predict_dim=args.predict_dim,
+                                shuffle=shuffle, rng=rng)
+        for x, y in prefetch(chunks):
+            for i in range(0, x.shape[0], args.batch_size):
+                yield x[i:i + args.batch_size], y[i:i + args.batch_size]
+
+    ds = tf.data.Dataset.from_generator(generator, output_signature=(
+        tf.TensorSpec(shape=(None, n_inputs), dtype=tf.float32),
+        tf.TensorSpec(shape=(None, n_outputs), dtype=tf.float32)))
+
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a pickled BMI data set to an array store')
+    parser.add_argument('--dataset', type=str, required=True, help='Pickled data set file')
+    parser.add_argument('--store', type=str, required=True, help='Array store directory')
+    args = parser.parse_args()
+
+    convert_dataset(args.dataset, args.store)
@@ -1,10 +1,11 @@
 import tensorflow as tf
-from tensorflow.keras.layers import InputLayer, Dense
+from tensorflow.keras import initializers, activations
+from tensorflow.keras.layers import InputLayer, Dense, Layer, Reshape
 from tensorflow.keras.models import Sequential
 
 
 def deep_network_basic(n_inputs, hidden_layers, n_output, activation='elu', activation_output='elu', lrate=0.001,
-                       metrics=None):
+                       metrics=None, n_projection=None):
     '''
     Construct a network with given architecture
     - Adam optimizer
@@ -17,10 +18,13 @@ def deep_network_basic(n_inputs, hidden_layers, n_output, activation='elu', acti
     :param activation_output: Activation function to be used for output units
     :param lrate: Learning rate for Adam Optimizer
     :param metrics: Metrics to record after each epoch
+    :param n_projection: Number of components of a fixed linear input projection (None for no projection).
+            The projection weights are loaded separately (see pca_projection.set_projection)
     '''
     # Build dense sequential model
     model = Sequential()
     model.add(InputLayer(input_shape=(n_inputs,)))
+    add_projection(model, n_projection)
     for i, n_hidden in enumerate(hidden_layers):
         model.add(Dense(n_hidden, use_bias=True, name='Hidden_%d' % i, activation=activation))
     model.add(Dense(n_output, use_bias=True, name='Output', activation=activation_output))
@@ -31,6 +35,142 @@ def deep_network_basic(n_inputs, hidden_layers, n_output, activation='elu', acti
     # Bind the optimizer and the loss function to the model
     model.compile(loss='mse', optimizer=opt, metrics=metrics)
 
-    # Generate an ASCII representation of the architecture
-    print(model.summary())
+    return model
+
+
+def fresh_initializer(initializer):
+    '''
+    Copy an initializer.  An unseeded initializer instance can return the same values
+    each time it is called, so each new set of weights needs its own instance.
+
+    :param initializer: Keras initializer
+    :return: New initializer with the same configuration
+    '''
+    return initializer.__class__.from_config(initializer.get_config())
+
+
+def add_projection(model, n_projection):
+    '''
+    Add a fixed (non-trainable) linear projection of the inputs
+
+    :param model: Sequential model
+    :param n_projection: Number of projected dimensions (None for no projection)
+    '''
+    if n_projection is not None:
+        model.add(Dense(n_projection, use_bias=True, name='Projection', activation=None, trainable=False))
+
+
+class BatchedDense(Layer):
+    '''
+    K independent dense layers evaluated as a single batched (block-diagonal) operation
+
+    Input: batch x inputs (shared by all K networks) or batch x K x inputs
+    Output: batch x K x units
+    '''
+
+    def __init__(self, nnets, units, activation=None, use_bias=True, kernel_initializer='glorot_uniform',
+                 bias_initializer='zeros', **kwargs):
+        '''
+        :param nnets: Number of independent networks (K)
+        :param units: Number of units in each network's layer
+        :param activation: Activation function
+        :param use_bias: Include a bias term
+        :param kernel_initializer: Initializer for each network's kernel (applied per network, so
+                the fan-in/fan-out match those of a single Dense layer)
+        :param bias_initializer: Initializer for the biases
+        '''
+        super(BatchedDense, self).__init__(**kwargs)
+        self.nnets = nnets
+        self.units = units
+        self.activation = activations.get(activation)
+        self.use_bias = use_bias
+        self.kernel_initializer = initializers.get(kernel_initializer)
+        self.bias_initializer = initializers.get(bias_initializer)
+
+    def initial_kernel(self, shape, dtype=None):
+        '''
+        Initialize each network's kernel separately
+
+        :param shape: Kernel shape (nnets x inputs x units)
+        '''
+        return tf.stack([fresh_initializer(self.kernel_initializer)(shape[1:], dtype=dtype)
+                         for _ in range(shape[0])])
+
+    def build(self, input_shape):
+        n_inputs = int(input_shape[-1])
+        self.kernel = self.add_weight(name='kernel', shape=(self.nnets, n_inputs, self.units),
+                                      initializer=self.initial_kernel)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', shape=(self.nnets, self.units),
+                                        initializer=self.bias_initializer)
+        else:
+            self.bias = None
+        super(BatchedDense, self).build(input_shape)
+
+    def call(self, inputs):
+        if len(inputs.shape) == 2:
+            # Shared input
+            outputs = tf.einsum('bi,kij->bkj', inputs, self.kernel)
+        else:
+            # One input per network
+            outputs = tf.einsum('bki,kij->bkj', inputs, self.kernel)
+
+        if self.use_bias:
+            outputs = outputs + self.bias
+
+        return self.activation(outputs)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.nnets, self.units)
+
+    def get_config(self):
+        base_config = super().get_config()
+        return {**base_config, "nnets": self.nnets, "units": self.units,
+                "activation": activations.serialize(self.activation), "use_bias": self.use_bias,
+                "kernel_initializer": initializers.serialize(self.kernel_initializer),
+                "bias_initializer": initializers.serialize(self.bias_initializer)}
+
+
+def deep_network_multi(n_inputs, hidden_layers, n_output, shared_layers=0, activation='elu',
+                       activation_output='elu', lrate=0.001, metrics=None, n_projection=None):
+    '''
+    Construct a network that predicts all output dimensions in one model
+    - The first shared_layers hidden layers form a trunk that is shared by all output dimensions
+    - The remaining hidden layers and the output unit are separate for each output dimension
+      (implemented as one BatchedDense layer per depth)
+    - With shared_layers=0, this is n_output independent networks trained together
+    - Adam optimizer
+    - MSE loss
+
+    :param n_inputs: Number of input dimensions
+    :param hidden_layers: Number of neurons in each hidden layer
+    :param n_output: Number of ouptut dimensions
+    :param shared_layers: Number of hidden layers shared across output dimensions
+    :param activation: Activation function to be used for hidden units
+    :param activation_output: Activation function to be used for output units
+    :param lrate: Learning rate for Adam Optimizer
+    :param metrics: Metrics to record after each epoch
+    :param n_projection: Number of components of a fixed linear input projection (None for no projection).
+            The projection weights are loaded separately (see pca_projection.set_projection)
+    '''
+    assert (0 <= shared_layers <= len(hidden_layers)), "shared_layers must be between 0 and the number of hidden layers"
+
+    # Build dense sequential model
+    model = Sequential()
+    model.add(InputLayer(input_shape=(n_inputs,)))
+    add_projection(model, n_projection)
+    for i, n_hidden in enumerate(hidden_layers):
+        if i < shared_layers:
+            model.add(Dense(n_hidden, use_bias=True, name='Hidden_%d' % i, activation=activation))
+        else:
+            model.add(BatchedDense(n_output, n_hidden, use_bias=True, name='Hidden_%d' % i, activation=activation))
+    model.add(BatchedDense(n_output, 1, use_bias=True, name='Output', activation=activation_output))
+    model.add(Reshape((n_output,), name='Output_reshape'))
+
+    # Optimizer
+    opt = tf.keras.optimizers.Adam(learning_rate=lrate, amsgrad=False)
+
+    # Bind the optimizer and the loss function to the model
+    model.compile(loss='mse', optimizer=opt, metrics=metrics)
+
     return model
@@ -0,0 +1,238 @@
+'''
+Export a trained predictor as a compact, compressed artifact
+
+The dense layers of a saved model (see --save) are compressed by:
+- Magnitude pruning: the smallest weights of each trainable layer are set to zero
+- Per-channel int8 quantization: each output unit's weights are scaled by their largest
+  magnitude and rounded to int8
+
+The artifact is a single compressed .npz file.  CompressedPredictor runs it on the CPU
+with NumPy; the int8 weights are dequantized once when the artifact is loaded, so
+inference uses dense float32 weights.  Compression therefore changes the artifact size
+and the FVAF, but not the latency.
+
+The report compares the test fold FVAF (FractionOfVarianceAccountedForSingle semantics)
+and the size of the Keras model, of a float32 baseline artifact (the same NumPy
+predictor without pruning or quantization) and of the compressed artifact.  Latency
+is reported for the Keras model and the NumPy predictor (the same for both artifacts).
+
+Models of multi-output runs (--multi_output) are not supported: their results are
+stored per output dimension.
+
+python export_predictor.py --fbase results/bmi__ddtheta_1_hidden_100_10_Ntraining_18_rotation_10 --sparsity 0.5
+
+Author: Brandon Michaud
+'''
+import argparse
+import json
+import numpy as np
+import os
+import tensorflow as tf
+import time
+
+from bmi_store import open_dataset_store
+from fvaf_analytics import fvaf_single
+from lag_features import fold_lags, lagged_inputs
+from results_io import dataset_fname, load_results, load_testing, results_exist, testing_folds
+
+# NumPy versions of the activation functions used by the networks
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'sigmoid': lambda x: 1.0 / (1.0 + np.exp(-x)),
+    'tanh': np.tanh,
+}
+
+
+def prune(kernel, sparsity):
+    '''
+    Magnitude pruning
+
+    :param kernel: Layer weights
+    :param sparsity: Fraction of the weights to set to zero
+    :return: Pruned copy of the weights
+    '''
+    if sparsity <= 0:
+        return kernel.copy()
+    threshold = np.quantile(np.abs(kernel), sparsity)
+    return np.where(np.abs(kernel) <= threshold, 0, kernel)
+
+
+def quantize(kernel):
+    '''
+    Per-channel symmetric int8 quantization (one scale per output unit)
+
+    :param kernel: Layer weights (... x inputs x units)
+    :return: int8 weights (same shape) and scales (... x 1 x units)
+    '''
+    scale = np.max(np.abs(kernel), axis=-2, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def compress_model(model, sparsity, quantized=True):
+    '''
+    Prune and quantize the dense layers of a model
+
+    :param model: Trained Keras model (Dense layers)
+    :param sparsity: Fraction of the weights of each trainable layer to set to zero
+    :param quantized: Quantize the weights to int8 (False: keep float32 weights)
+    :return: Dictionary of arrays for the artifact
+    '''
+    arrays = {}
+    layers = []
+    for layer in model.layers:
+        config = layer.get_config()
+        kind = layer.__class__.__name__
+        assert kind == 'Dense', "Unsupported layer: %s" % kind
+        assert config['activation'] in ACTIVATIONS, "Unsupported activation: %s" % config['activation']
+
+        # The input projection is not trainable and is not pruned
+        kernel = layer.kernel.numpy()
+        if layer.trainable:
+            kernel = prune(kernel, sparsity)
+        i = len(layers)
+        if quantized:
+            arrays['kernel_%d' % i], arrays['scale_%d' % i] = quantize(kernel)
+        else:
+            arrays['kernel_%d' % i] = kernel.astype(np.float32)
+        if layer.bias is not None:
+            arrays['bias_%d' % i] = layer.bias.numpy().astype(np.float32)
+        layers.append({'name': layer.name, 'activation': config['activation']})
+
+    arrays['layers'] = np.array(json.dumps(layers))
+    return arrays
+
+
+class CompressedPredictor():
+    def __init__(self, fname):
+        '''
+        Load a compressed artifact
+
+        :param fname: Artifact file name
+        '''
+        with np.load(fname) as artifact:
+            self.layers = json.loads(str(artifact['layers']))
+            self.weights = []
+            for i, layer in enumerate(self.layers):
+                # Dequantize once (float32 artifacts have no scales)
+                kernel = artifact['kernel_%d' % i].astype(np.float32)
+                if 'scale_%d' % i in artifact:
+                    kernel = kernel * artifact['scale_%d' % i]
+                bias = artifact['bias_%d' % i] if 'bias_%d' % i in artifact else None
+                self.weights.append((kernel, bias))
+
+    def predict(self, x):
+        '''
+        :param x: Inputs (shape: samples x inputs)
+        :return: Predictions (shape: samples x outputs)
+        '''
+        h = np.asarray(x, dtype=np.float32)
+        for layer, weights in zip(self.layers, self.weights):
+            kernel, bias = weights
+            h = h @ kernel
+            if bias is not None:
+                h = h + bias
+            h = ACTIVATIONS[layer['activation']](h)
+        return h
+
+
+def testing_inputs(header, bmi):
+    '''
+    Inputs of the testing set of a run (with the run's lag windows, if any)
+
+    :param header: Results header
+    :param bmi: Dictionary containing the full BMI data set
+    :return: Inputs (shape: samples x inputs)
+    '''
+    nlags = header['args'].get('lags')
+    folds = testing_folds(header)
+    if nlags is None:
+        return np.concatenate([bmi['MI'][f] for f in folds], axis=0)
+    return np.concatenate([lagged_inputs(*fold_lags(bmi, f, nlags)) for f in folds], axis=0)
+
+
+def latency(predict, x, repeats):
+    '''
+    :return: Median time (seconds) of predict(x) over the repeats
+    '''
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        predict(x)
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def directory_size(path):
+    '''
+    :return: Total size (bytes) of the files in a directory (or of a single file)
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def export_predictor(fbase, sparsity=0.5, repeats=100):
+    '''
+    Compress a saved model and report its accuracy, size and latency
+
+    :param fbase: Base file name of the run (results and model saved with --save)
+    :param sparsity: Fraction of the weights of each trainable layer to set to zero
+    :param repeats: Number of repetitions for the latency measurements
+    :return: Dictionary with the report
+    '''
+    # Multi-output runs save one model for all dimensions, but only per-dimension results
+    assert results_exist(fbase), "No results for %s (models of multi-output runs cannot be exported)" % fbase
+    header = load_results(fbase)
+    assert header['args'].get('multi_output') is None, "Models of multi-output runs cannot be exported"
+
+    bmi = open_dataset_store(dataset_fname(header))
+    x = testing_inputs(header, bmi).astype(np.float32)
+    _, actual = load_testing(header, bmi)
+    assert x.shape[0] == actual.shape[0], "The testing inputs do not match the stored testing outputs"
+
+    fname_model = "%s_model" % fbase
+    model = tf.keras.models.load_model(fname_model, compile=False)
+
+    # Write and reload the artifacts, so the report describes what was written
+    fname_baseline = "%s_predictor_float32.npz" % fbase
+    np.savez_compressed(fname_baseline, **compress_model(model, 0.0, quantized=False))
+    baseline = CompressedPredictor(fname_baseline)
+
+    fname_artifact = "%s_predictor.npz" % fbase
+    np.savez_compressed(fname_artifact, **compress_model(model, sparsity))
+    predictor = CompressedPredictor(fname_artifact)
+
+    report = {'sparsity': sparsity,
+              'fvaf_model': float(fvaf_single(actual, model.predict(x, verbose=0))),
+              'fvaf_float32': float(fvaf_single(actual, baseline.predict(x))),
+              'fvaf_compressed': float(fvaf_single(actual, predictor.predict(x))),
+              'size_model': directory_size(fname_model),
+              'size_float32': directory_size(fname_baseline),
+              'size_compressed': directory_size(fname_artifact),
+              'latency_model_single': latency(lambda v: model(v, training=False), x[:1], repeats),
+              'latency_numpy_single': latency(predictor.predict, x[:1], repeats),
+              'latency_model_testing': latency(lambda v: model(v, training=False), x, repeats),
+              'latency_numpy_testing': latency(predictor.predict, x, repeats)}
+
+    with open("%s_export.json" % fbase, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compress a trained BMI predictor')
+    parser.add_argument('--fbase', type=str, required=True, help='Base file name of the run (model saved with --save)')
+    parser.add_argument('--sparsity', type=float, default=0.5, help='Fraction of weights to prune in each trainable layer')
+    parser.add_argument('--repeats', type=int, default=100, help='Repetitions for latency measurements')
+    args = parser.parse_args()
+
+    assert (0.0 <= args.sparsity < 1.0), "Sparsity must be between 0 and 1"
+
+    report = export_predictor(args.fbase, sparsity=args.sparsity, repeats=args.repeats)
+    for k, v in report.items():
+        print("%s: %s" % (k, v))
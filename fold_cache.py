@@ -0,0 +1,80 @@
+'''
+Cache for values computed from the folds of a data set
+
+Values (e.g., the valid lag windows or the PCA statistics of a fold) are keyed by the
+data set file name, the fold and a description of the computation, so they are reused
+when the same data set is loaded again in the same process.  The cache never holds the
+data set's arrays themselves, and its total size is bounded: the least recently used
+values are dropped first.
+
+Data sets loaded through bmi_store.load_dataset() record their file name under the
+'fname' key.  Values for a data set without a file name are computed but not cached.
+
+Author: Brandon Michaud
+'''
+from collections import OrderedDict
+import numpy as np
+
+
+def _nbytes(value):
+    '''
+    :return: Number of bytes held by the numpy arrays in a value (an array or a tuple of them)
+    '''
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    return value.nbytes if isinstance(value, np.ndarray) else 0
+
+
+class FoldCache():
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        '''
+        Constructor
+
+        :param max_bytes: Maximum total size of the cached arrays
+        '''
+        self.max_bytes = max_bytes
+        # Key -> (value, size)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, bmi, fold, name, compute):
+        '''
+        Return a cached value, computing it if needed
+
+        :param bmi: Dictionary containing the full BMI data set
+        :param fold: Fold index
+        :param name: Hashable description of the computation (including its parameters)
+        :param compute: Function of no arguments that computes the value
+        :return: The value
+        '''
+        fname = bmi.get('fname')
+        if fname is None:
+            return compute()
+
+        key = (fname, int(fold), name)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        value = compute()
+        size = _nbytes(value)
+        if size <= self.max_bytes:
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            # Drop the least recently used values
+            while self.nbytes > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.nbytes -= old_size
+
+        return value
+
+    def clear(self):
+        '''
+        Drop all cached values
+        '''
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+
+# Cache shared by all per-fold computations in this process
+fold_cache = FoldCache()
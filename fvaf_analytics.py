@@ -0,0 +1,254 @@
+'''
+Offline FVAF/RMSE analytics over stored predictions
+
+All metrics are computed in NumPy from the arrays stored in the results files,
+so no model evaluation (or TensorFlow) is needed.  Sums are accumulated in float64
+in the same way as FractionOfVarianceAccountedFor, so the results match the Keras
+metric to numerical tolerance.
+
+Arrays follow a common layout: runs x samples x outputs.  Runs generally have
+test folds of different lengths; these are padded to a common length and a
+boolean mask (runs x samples) marks the valid samples.
+
+Author: Brandon Michaud
+'''
+import numpy as np
+
+from results_io import load_results, load_predictions, load_testing
+
+
+def stack_runs(actuals, predicts):
+    '''
+    Pad a list of runs to a common length and stack them
+
+    :param actuals: List of true value arrays (each shape: samples x outputs)
+    :param predicts: List of predicted value arrays (same shapes as actuals)
+    :return: actual (runs x samples x outputs), predict (runs x samples x outputs)
+            and mask (runs x samples)
+    '''
+    assert len(actuals) == len(predicts), "Need one prediction array per run"
+
+    nruns = len(actuals)
+    nsamples = max(a.shape[0] for a in actuals)
+    ndims = actuals[0].shape[1]
+
+    actual = np.zeros((nruns, nsamples, ndims), dtype=np.float64)
+    predict = np.zeros((nruns, nsamples, ndims), dtype=np.float64)
+    mask = np.zeros((nruns, nsamples), dtype=bool)
+
+    for r, (a, p) in enumerate(zip(actuals, predicts)):
+        assert a.shape == p.shape, "Actual and predicted shapes must match"
+        n = a.shape[0]
+        actual[r, :n] = a
+        predict[r, :n] = p
+        mask[r, :n] = True
+
+    return actual, predict, mask
+
+
+def load_runs(fnames, bmi=None):
+    '''
+    Load the stored testing predictions for a set of runs
+
+    :param fnames: List of results file names
+    :param bmi: Dictionary containing the full BMI data set (needed when the actual outputs
+            and times are only referenced by the results files; see results_io)
+    :return: actual, predict and mask (see stack_runs()), and the time (runs x samples)
+    '''
+    actuals = []
+    predicts = []
+    times = []
+    for fname in fnames:
+        header = load_results(fname)
+        t, a = load_testing(header, bmi)
+        actuals.append(a)
+        predicts.append(load_predictions(header))
+        times.append(t)
+
+    actual, predict, mask = stack_runs(actuals, predicts)
+
+    time = np.zeros(mask.shape, dtype=np.float64)
+    for r, t in enumerate(times):
+        time[r, :t.shape[0]] = np.ravel(t)
+
+    return actual, predict, mask, time
+
+
+def _weights(actual, mask):
+    '''
+    Per-sample weights (... x samples x 1); all ones if there is no mask
+    '''
+    if mask is None:
+        return np.ones(actual.shape[:-1] + (1,), dtype=np.float64)
+    return np.asarray(mask, dtype=np.float64)[..., None]
+
+
+def sufficient_statistics(actual, predict, mask=None):
+    '''
+    Compute the sums accumulated by FractionOfVarianceAccountedFor
+
+    :param actual: True values (... x samples x outputs)
+    :param predict: Predicted values (same shape as actual)
+    :param mask: Valid samples (... x samples); None if all are valid
+    :return: N (... x 1), sum (... x outputs), sum of squares (... x outputs),
+            sum of squared errors (... x outputs)
+    '''
+    actual = np.asarray(actual, dtype=np.float64)
+    predict = np.asarray(predict, dtype=np.float64)
+    w = _weights(actual, mask)
+
+    N = np.sum(w, axis=-2)
+    s = np.sum(w * actual, axis=-2)
+    ss = np.sum(w * np.square(actual), axis=-2)
+    sse = np.sum(w * np.square(actual - predict), axis=-2)
+
+    return N, s, ss, sse
+
+
+def fvaf_from_statistics(N, s, ss, sse):
+    '''
+    FVAF = 1 - mse / var, from the accumulated sums
+
+    :return: FVAF for each output dimension
+    '''
+    mean = s / N
+    variance = ss / N - np.square(mean)
+    return 1.0 - (sse / N) / variance
+
+
+def fvaf(actual, predict, mask=None):
+    '''
+    FVAF for each output dimension (FractionOfVarianceAccountedFor semantics)
+
+    :param actual: True values (... x samples x outputs)
+    :param predict: Predicted values (same shape as actual)
+    :param mask: Valid samples (... x samples); None if all are valid
+    :return: FVAF (... x outputs)
+    '''
+    return fvaf_from_statistics(*sufficient_statistics(actual, predict, mask))
+
+
+def fvaf_single(actual, predict, mask=None):
+    '''
+    FVAF averaged across the output dimensions (FractionOfVarianceAccountedForSingle semantics)
+
+    :return: FVAF (...)
+    '''
+    return np.mean(fvaf(actual, predict, mask), axis=-1)
+
+
+def rmse(actual, predict, mask=None):
+    '''
+    Root mean squared error for each output dimension
+
+    :return: RMSE (... x outputs)
+    '''
+    N, _, _, sse = sufficient_statistics(actual, predict, mask)
+    return np.sqrt(sse / N)
+
+
+def rmse_single(actual, predict, mask=None):
+    '''
+    Root mean squared error over all samples and output dimensions
+    (tf.keras.metrics.RootMeanSquaredError semantics)
+
+    :return: RMSE (...)
+    '''
+    N, _, _, sse = sufficient_statistics(actual, predict, mask)
+    return np.sqrt(np.sum(sse, axis=-1) / (N[..., 0] * sse.shape[-1]))
+
+
+def windowed_fvaf(actual, predict, window, step=None, mask=None):
+    '''
+    FVAF over consecutive windows of samples
+
+    Window sums are computed from cumulative sums, so the cost does not depend on
+    the window length.  Windows that contain fewer than two valid samples are NaN.
+
+    :param actual: True values (... x samples x outputs)
+    :param predict: Predicted values (same shape as actual)
+    :param window: Number of samples in each window
+    :param step: Number of samples between window starts (default: window)
+    :param mask: Valid samples (... x samples); None if all are valid
+    :return: FVAF (... x windows x outputs)
+    '''
+    if step is None:
+        step = window
+
+    actual = np.asarray(actual, dtype=np.float64)
+    predict = np.asarray(predict, dtype=np.float64)
+    w = _weights(actual, mask)
+    nsamples = actual.shape[-2]
+    assert 0 < window <= nsamples, "Window must be between 1 and the number of samples"
+
+    # Stack the per-sample terms so that one cumulative sum covers all of them
+    terms = np.stack(np.broadcast_arrays(w, w * actual, w * np.square(actual),
+                                         w * np.square(actual - predict)), axis=0)
+    zeros = np.zeros(terms.shape[:-2] + (1,) + terms.shape[-1:], dtype=np.float64)
+    csum = np.concatenate([zeros, np.cumsum(terms, axis=-2)], axis=-2)
+
+    starts = np.arange(0, nsamples - window + 1, step)
+    sums = csum[..., starts + window, :] - csum[..., starts, :]
+    N, s, ss, sse = sums
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = fvaf_from_statistics(N, s, ss, sse)
+    result[np.broadcast_to(N < 2, result.shape)] = np.nan
+
+    return result
+
+
+def bootstrap_fvaf(actual, predict, mask=None, nboot=1000, batch_size=100, seed=None):
+    '''
+    Bootstrap distribution of the FVAF of each run
+
+    Samples are drawn with replacement from the valid samples of each run.  Resamples
+    are generated in batches of batch_size so that memory use is bounded by
+    batch_size x runs x samples x outputs.
+
+    :param actual: True values (runs x samples x outputs)
+    :param predict: Predicted values (same shape as actual)
+    :param mask: Valid samples (runs x samples); None if all are valid.  Valid samples
+            must come first in each run (as produced by stack_runs())
+    :param nboot: Number of bootstrap resamples
+    :param batch_size: Number of resamples to generate at once
+    :param seed: Random seed
+    :return: FVAF for each resample (nboot x runs x outputs)
+    '''
+    actual = np.asarray(actual, dtype=np.float64)
+    predict = np.asarray(predict, dtype=np.float64)
+    nruns, nsamples, ndims = actual.shape
+
+    if mask is None:
+        mask = np.ones((nruns, nsamples), dtype=bool)
+    counts = np.sum(mask, axis=1)
+
+    rng = np.random.default_rng(seed)
+    out = np.empty((nboot, nruns, ndims), dtype=np.float64)
+
+    for start in range(0, nboot, batch_size):
+        nb = min(batch_size, nboot - start)
+
+        # Indices into the valid samples of each run (nb x runs x samples)
+        idx = (rng.random((nb, nruns, nsamples)) * counts[None, :, None]).astype(np.intp)
+        idx = idx[..., None]
+
+        a = np.take_along_axis(actual[None], idx, axis=2)
+        p = np.take_along_axis(predict[None], idx, axis=2)
+
+        # Only the first counts[r] draws belong to the resample of run r
+        out[start:start + nb] = fvaf(a, p, np.broadcast_to(mask[None], (nb, nruns, nsamples)))
+
+    return out
+
+
+def confidence_interval(samples, alpha=0.05):
+    '''
+    Percentile confidence interval from bootstrap samples
+
+    :param samples: Bootstrap samples (resamples x ...)
+    :param alpha: 1 - confidence level
+    :return: Lower and upper bounds (each shape: ...)
+    '''
+    lower, upper = np.percentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return lower, upper
@@ -15,6 +15,7 @@ import socket
 
 import pickle
 import argparse
+import copy
 import os
 import sys
 from tensorflow.keras.utils import plot_model
@@ -22,6 +23,11 @@ from tensorflow.keras.utils import plot_model
 from deep_networks import *
 from symbiotic_metrics import *
 from job_control import *
+from bmi_store import *
+from lag_features import *
+from model_pool import *
+from pca_projection import *
+from results_io import *
 
 
 # Location for libraries (you will likely just use './')
@@ -32,24 +38,19 @@ sys.path.append(tf_tools + "networks")
 sys.path.append(tf_tools + "experiment_control")
 
 
-def extract_data(bmi, args):
+def select_folds(bmi, args):
     '''
-    Translate BMI data structure from the file into a data set for training/evaluating a single model
-    
-    :param bmi: Dictionary containing the full BMI data set, as loaded from the pickle file.
-    :param args: Argparse object, which contains key information, including Nfolds, 
-            predict_dim, output_type, rotation
-            
-    :return: Numpy arrays in standard TF format for training set input/output, 
-            validation set input/output and testing set input/output; and a
-            dictionary containing the lists of folds that have been chosen
+    Choose the training, validation and testing folds for a single model
+
+    :param bmi: Dictionary containing the full BMI data set
+    :param args: Argparse object, which contains key information, including Nfolds,
+            predict_dim, output_type, rotation, Ntraining
+
+    :return: Dictionary containing the lists of folds that have been chosen
     '''
     # Number of folds in the data set
-    ins = bmi['MI']
-    Nfolds = len(ins)
-    
-    times = bmi['time']
-    
+    Nfolds = len(bmi['MI'])
+
     # Check that argument matches actual number of folds
     assert (Nfolds == args.Nfolds), "Nfolds must match folds in data set"
     
@@ -69,8 +70,34 @@ def extract_data(bmi, args):
     folds_testing = (np.array([Nfolds-1]) + r) % Nfolds
     
     # Log these choices
-    folds = {'folds_training': folds_training, 'folds_validation': folds_validation, 'folds_testing': folds_testing}
+    return {'folds_training': folds_training, 'folds_validation': folds_validation, 'folds_testing': folds_testing}
+
+
+def extract_data(bmi, args):
+    '''
+    Translate BMI data structure from the file into a data set for training/evaluating a single model
     
+    :param bmi: Dictionary containing the full BMI data set, as loaded from the pickle file.
+    :param args: Argparse object, which contains key information, including Nfolds, 
+            predict_dim, output_type, rotation
+            
+    :return: Numpy arrays in standard TF format for training set input/output, 
+            validation set input/output and testing set input/output; and a
+            dictionary containing the lists of folds that have been chosen
+    '''
+    ins = bmi['MI']
+    times = bmi['time']
+    outs = bmi[args.output_type]
+
+    # Compute which folds belong in which set
+    folds = select_folds(bmi, args)
+    folds_training = folds['folds_training']
+    folds_validation = folds['folds_validation']
+    folds_testing = folds['folds_testing']
+
+    # Lag windows are never copied into full data sets: they are streamed (see stream_folds)
+    assert args.lags is None, "Lag windows must be streamed"
+
     # Combine the folds into training/val/test data sets (pairs of input/output numpy arrays)
     ins_training = np.concatenate([ins[i] for i in folds_training], axis=0)
     outs_training = np.concatenate([outs[i] for i in folds_training], axis=0)
@@ -159,6 +186,10 @@ def generate_fname(args, params_str):
     else:
         predict_str = '%s_%d' % (args.output_type, args.predict_dim)
 
+    # Multi-output mode (all dimensions predicted by one model)
+    if args.multi_output is not None:
+        predict_str = '%s_multi_%s' % (predict_str, args.multi_output)
+
     if args.L1_regularization is not None:
         Lx_str = '_L1_%f' % args.L1_regularization
         
@@ -166,10 +197,61 @@ def generate_fname(args, params_str):
         Lx_str = '_L2_%f' % args.L2_regularization
     else:
         Lx_str = ''
-        
+
+    # Lag window
+    if args.lags is None:
+        lags_str = ''
+    else:
+        lags_str = '_lags_%d' % args.lags
+
+    # Input projection
+    if args.pca is None:
+        pca_str = ''
+    else:
+        pca_str = '_pca_%d' % args.pca
+
     # Put it all together, including #of training folds and the experiment rotation
-    return "%s/%s_%s_%s%s_hidden_%s_%s" % (args.results_path, args.exp_type, args.label, predict_str, Lx_str,
-                                           hidden_str, params_str)
+    return "%s/%s_%s_%s%s%s%s_hidden_%s_%s" % (args.results_path, args.exp_type, args.label, predict_str, Lx_str,
+                                               lags_str, pca_str, hidden_str, params_str)
+
+
+def generate_dim_fnames(args, params_str, ndims):
+    '''
+    Generate the base file names for each output dimension of a multi-output run.
+
+    These are the names that separate runs with --predict_dim would have used, tagged with
+    the multi-output mode (so the modes do not collide with each other or with --predict_dim runs).
+
+    :param args: Argparse arguments
+    :param params_str: String describing the experiment parameters
+    :param ndims: Number of output dimensions
+    :return: List of base file names (one per output dimension)
+    '''
+    fbases = []
+    for d in range(ndims):
+        args_dim = copy.copy(args)
+        args_dim.predict_dim = d
+        fbases.append(generate_fname(args_dim, params_str))
+    return fbases
+
+
+def fvaf_per_dim(model, ins, outs=None):
+    '''
+    Compute the FVAF of each output dimension
+
+    :param model: Trained model
+    :param ins: Inputs (shape: samples x inputs), or a streamed data set of (inputs, outputs) batches
+    :param outs: Expected outputs (shape: samples x outputs); None for a streamed data set
+    :return: Numpy array of FVAFs (shape: outputs)
+    '''
+    fvaf = FractionOfVarianceAccountedFor(model.output_shape[-1])
+    if outs is None:
+        # Accumulate over the batches of the stream
+        for x, y in ins:
+            fvaf.update_state(y, model.predict_on_batch(x))
+    else:
+        fvaf.update_state(outs, model.predict(ins))
+    return fvaf.result().numpy()
 
 
 def execute_exp(args=None):
@@ -177,6 +259,9 @@ def execute_exp(args=None):
     Perform the training and evaluation for a single model
     
     @args Argparse arguments
+    @return The trained model (None if the run was skipped).  The model belongs to
+            model_pool: the next run with the same network configuration in this process
+            re-initializes it in place, so save it (--save) or clone it to keep it
     '''
     # Check the arguments
     if args is None:
@@ -195,25 +280,49 @@ def execute_exp(args=None):
     
     print("File name base:", fbase)
 
-    # Output pickle file name
-    fname_out = "%s_results.pkl" % fbase
+    # Output results file name
+    fname_out = results_fname(fbase)
 
-    # Check if this file exists
-    if os.path.exists(fname_out):
+    # Check if this file exists (in either results format)
+    if results_exist(fbase):
         # File exists: abort the run
         print("File already exists")
         return None
     
-    # Load the data
-    bmi = None
-    with open(args.dataset, "rb") as fp:
-        bmi = pickle.load(fp)
+    # Load the data (an array store is memory mapped rather than read)
+    bmi = load_dataset(args.dataset)
 
     assert bmi is not None, "Unable to load data"
 
-    # Extract the data sets.  This process uses rotation and Ntraining (among other exp args)
-    (ins_training, outs_training, time_training, ins_validation, outs_validation, time_validation, ins_testing,
-     outs_testing, time_testing, folds) = extract_data(bmi, args)
+    if args.stream or args.lags is not None:
+        # Streamed data sets: the outputs are part of each stream.  Lag windows are always
+        # streamed, so that only one chunk of windows is copied out of the strided views at a time
+        folds = select_folds(bmi, args)
+        ins_training = stream_folds(bmi, folds['folds_training'], args, shuffle=True)
+        ins_validation = stream_folds(bmi, folds['folds_validation'], args)
+        ins_testing = stream_folds(bmi, folds['folds_testing'], args)
+        outs_training = outs_validation = outs_testing = None
+
+        n_inputs = ins_training.element_spec[0].shape[1]
+        n_outputs = ins_training.element_spec[1].shape[1]
+    else:
+        # Extract the data sets.  This process uses rotation and Ntraining (among other exp args)
+        (ins_training, outs_training, time_training, ins_validation, outs_validation, time_validation, ins_testing,
+         outs_testing, time_testing, folds) = extract_data(bmi, args)
+
+        n_inputs = ins_training.shape[1]
+        n_outputs = outs_training.shape[1]
+
+    # The PCA statistics grow with the square of the number of inputs
+    assert args.pca is None or n_inputs <= MAX_INPUTS, \
+        "PCA is limited to %d inputs (%d with --lags %s): use fewer lags" % (MAX_INPUTS, n_inputs, args.lags)
+
+    # Multi-output runs write one results file per output dimension
+    if args.multi_output is not None:
+        fbases_dim = generate_dim_fnames(args, params_str, n_outputs)
+        if all(results_exist(f) for f in fbases_dim):
+            print("Files already exist")
+            return None
 
     # Is this a test run?
     if args.nogo:
@@ -230,12 +339,34 @@ def execute_exp(args=None):
     wandb.log({'hostname': socket.gethostname()})
 
     # Metrics
-    fvaf = FractionOfVarianceAccountedForSingle(outs_training.shape[1])
+    fvaf = FractionOfVarianceAccountedForSingle(n_outputs)
     rmse = tf.keras.metrics.RootMeanSquaredError()
 
-    # Build the model
-    model = deep_network_basic(ins_training.shape[1], args.hidden, outs_training.shape[1], activation=args.activation_hidden,
-                               activation_output=args.activation_out, lrate=args.lrate, metrics=[fvaf, rmse])
+    # Build the model (or reuse a compiled one from an earlier run in this process)
+    if args.multi_output is None:
+        model = model_pool.get_model(deep_network_basic, [fvaf, rmse], lrate=args.lrate, n_inputs=n_inputs,
+                                     hidden_layers=args.hidden, n_output=n_outputs, n_projection=args.pca,
+                                     activation=args.activation_hidden, activation_output=args.activation_out)
+    else:
+        # Shared: all hidden layers are shared and only the output units are per dimension.
+        # Independent: nothing is shared
+        shared_layers = len(args.hidden) if args.multi_output == 'shared' else 0
+        model = model_pool.get_model(deep_network_multi, [fvaf, rmse], lrate=args.lrate, n_inputs=n_inputs,
+                                     hidden_layers=args.hidden, n_output=n_outputs, shared_layers=shared_layers,
+                                     n_projection=args.pca, activation=args.activation_hidden,
+                                     activation_output=args.activation_out)
+
+    # Input projection from the (cached) statistics of the training folds
+    if args.pca is not None:
+        # Statistics that do not fit in memory are cached on disk, so later runs do not reread the folds
+        cache_dir = args.pca_cache
+        if cache_dir is None and not statistics_fit_in_memory(bmi, folds['folds_training'], args.lags):
+            cache_dir = os.path.join(args.results_path, 'pca_cache')
+            print("PCA statistics do not fit in memory; caching them in %s" % cache_dir)
+
+        mean, components = pca_projection(bmi, folds['folds_training'], args.pca, nlags=args.lags,
+                                          cache_dir=cache_dir)
+        set_projection(model, mean, components)
     
     # Report if verbosity is turned on
     if args.verbose >= 1:
@@ -256,33 +387,49 @@ def execute_exp(args=None):
     wandb_metrics_cb = wandb.keras.WandbMetricsLogger()
     cbs.append(wandb_metrics_cb)
     
-    # Learn
+    # Learn (for streamed data sets, the outputs are None and are taken from the stream)
     history = model.fit(x=ins_training, y=outs_training,
                         epochs=args.epochs,
                         verbose=args.verbose >= 2,
                         validation_data=(ins_validation, outs_validation), 
                         callbacks=cbs)
         
-    # Generate log data
-    results = {}
-    results['args'] = args
-
-    # Task 1 data
-    results['predict_testing'] = model.predict(ins_testing)
-    results['actual_testing'] = outs_testing
-    results['time_testing'] = time_testing
-
-    # Task 2 data
-    results['predict_training_fvaf'] = model.evaluate(ins_training, outs_training)[1]
-    results['predict_validation_fvaf'] = model.evaluate(ins_validation, outs_validation)[1]
-    results['predict_testing_fvaf'] = model.evaluate(ins_testing, outs_testing)[1]
-    
-    # Save results
-    results['fname_base'] = fbase
-    with open(fname_out, "wb") as fp:
-        pickle.dump(results, fp)
+    # Actual outputs and times of the testing set are not stored: they are referenced
+    # through folds['folds_testing']
+    if args.multi_output is None:
+        # Task 1 data
+        predict_testing = model.predict(ins_testing)
+
+        # Task 2 data
+        metrics = {}
+        metrics['predict_training_fvaf'] = model.evaluate(ins_training, outs_training)[1]
+        metrics['predict_validation_fvaf'] = model.evaluate(ins_validation, outs_validation)[1]
+        metrics['predict_testing_fvaf'] = model.evaluate(ins_testing, outs_testing)[1]
+
+        # Save results
+        save_results(fbase, args, folds, predict_testing, metrics)
+    else:
+        # Per-dimension FVAFs
+        predict_testing = model.predict(ins_testing)
+        fvafs_training = fvaf_per_dim(model, ins_training, outs_training)
+        fvafs_validation = fvaf_per_dim(model, ins_validation, outs_validation)
+        fvafs_testing = fvaf_per_dim(model, ins_testing, outs_testing)
+
+        # Write the results as if each dimension had been run separately with --predict_dim
+        for d, fbase_dim in enumerate(fbases_dim):
+            args_dim = copy.copy(args)
+            args_dim.predict_dim = d
+
+            # Task 2 data
+            metrics = {}
+            metrics['predict_training_fvaf'] = fvafs_training[d]
+            metrics['predict_validation_fvaf'] = fvafs_validation[d]
+            metrics['predict_testing_fvaf'] = fvafs_testing[d]
+
+            # Save results
+            save_results(fbase_dim, args_dim, folds, predict_testing[:, [d]], metrics)
     
-    # Save the model (can't be included in the pickle file)
+    # Save the model (can't be included in the results file)
     if args.save:
         model.save("%s_model" % fbase)
 
@@ -304,10 +451,18 @@ def create_parser():
     parser.add_argument('--output_type', type=str, default='torque', help='Type to predict')
     parser.add_argument('--predict_dim', type=int, default=None, help="Dimension of the output to predict")
     parser.add_argument('--Nfolds', type=int, default=20, help='Maximum number of folds')
+    parser.add_argument('--stream', action='store_true', help='Stream the data set in chunks from a memory mapped array store (--dataset must be the store directory); runs with --lags are always streamed')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Number of rows read at once when streaming (the shuffle buffer)')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size when streaming')
+    parser.add_argument('--multi_output', type=str, default=None, choices=['shared', 'independent'],
+                        help='Predict all output dimensions in one model: shared hidden layers with per-dimension output units, or independent networks')
 
     # Network details
     parser.add_argument('--activation_out', type=str, default='sigmoid', help='Activation for output layer')
     parser.add_argument('--activation_hidden', type=str, default='sigmoid', help='Activation for hidden layers')
+    parser.add_argument('--lags', type=int, default=None, help='Number of time steps of MI in each input (lag window)')
+    parser.add_argument('--pca', type=int, default=None, help='Number of principal components of the inputs to keep (input projection; at most MAX_INPUTS inputs, including lags)')
+    parser.add_argument('--pca_cache', type=str, default=None, help='Directory for cached per-fold PCA statistics (default: RESULTS_PATH/pca_cache when they do not fit in memory)')
     parser.add_argument('--hidden', nargs='+', type=int, default=[10, 5], help='Number of hidden units per layer (sequence of ints)')
 
     # Experiment details
@@ -361,6 +516,11 @@ def check_args(args):
     assert (0 <= args.rotation < args.Nfolds), "Rotation must be between 0 and Nfolds"
     assert (1 <= args.Ntraining <= (args.Nfolds - 2)), "Ntraining must be between 1 and Nfolds-2"
     assert (0.0 < args.lrate < 1), "Lrate must be between 0 and 1"
+    assert (args.multi_output is None or args.predict_dim is None), "multi_output predicts all dimensions; do not set predict_dim"
+    assert (args.chunk_size >= args.batch_size > 0), "chunk_size must be at least batch_size"
+    assert (not args.stream or os.path.isdir(args.dataset)), "stream requires an array store for dataset (see bmi_store.py)"
+    assert (args.lags is None or args.lags >= 1), "lags must be at least 1"
+    assert (args.pca is None or args.pca >= 1), "pca must be at least 1"
 
 
 def check_completeness(args):
@@ -383,19 +543,27 @@ def check_completeness(args):
 
     print("MISSING RUNS:")
 
+    # Multi-output runs write one results file per output dimension
+    ndims = None
+    if args.multi_output is not None:
+        ndims = load_dataset(args.dataset)[args.output_type][0].shape[1]
+
     indices = []
     # Iterate over all possible jobs
     for i in range(ji.get_njobs()):
         params_str = ji.set_attributes_by_index(i, args)
-        # Compute output file name base
-        fbase = generate_fname(args, params_str)
+        # Compute output file name base(s)
+        if ndims is None:
+            fbases = [generate_fname(args, params_str)]
+        else:
+            fbases = generate_dim_fnames(args, params_str, ndims)
     
-        # Output pickle file name
-        fname_out = "%s_results.pkl"%(fbase)
+        # Output results file names
+        fnames_out = [results_fname(f) for f in fbases if not results_exist(f)]
 
-        if not os.path.exists(fname_out):
+        if len(fnames_out) > 0:
             # Results file does not exist: report it
-            print("%3d\t%s" % (i, fname_out))
+            print("%3d\t%s" % (i, ', '.join(fnames_out)))
             indices.append(i)
 
     # Give the list of indices that can be inserted into the --array line of the batch file
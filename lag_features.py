@@ -0,0 +1,102 @@
+'''
+Time-lagged input features
+
+A lagged input for time step t is the MI vectors of steps t-nlags+1 .. t.  The windows
+of each fold are built as a strided view of the fold's MI array, so no window is
+copied until a set of rows is selected (e.g., one chunk of a stream).  Windows never
+cross a fold boundary (each fold is windowed separately) or a gap in the fold's time
+array.
+
+The valid windows of each fold are cached (see fold_cache), so sweeping over experiments
+in one process finds them once per (data set, fold, nlags).  The view itself costs
+nothing to build and is not cached.
+
+Author: Brandon Michaud
+'''
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from fold_cache import fold_cache
+
+# A time step more than this multiple of the median step is treated as a gap
+GAP_FACTOR = 1.5
+
+
+def lag_windows(ins, time, nlags):
+    '''
+    Build the lag windows of one fold
+
+    :param ins: MI array for the fold (shape: samples x features)
+    :param time: Time array for the fold (shape: samples or samples x 1)
+    :param nlags: Number of time steps in each window
+    :return: Windows view (shape: samples-nlags+1 x nlags x features) and the indices of the
+            windows that do not cross a time gap.  Window w ends at sample w+nlags-1
+    '''
+    return window_view(ins, nlags), valid_windows(time, nlags)
+
+
+def window_view(ins, nlags):
+    '''
+    :param ins: MI array for the fold (shape: samples x features)
+    :param nlags: Number of time steps in each window
+    :return: Windows view (shape: samples-nlags+1 x nlags x features)
+    '''
+    assert ins.shape[0] >= nlags, "Fold is shorter than the lag window"
+
+    # sliding_window_view puts the window axis last; move it before the features
+    return sliding_window_view(ins, nlags, axis=0).transpose(0, 2, 1)
+
+
+def valid_windows(time, nlags):
+    '''
+    :param time: Time array for the fold (shape: samples or samples x 1)
+    :param nlags: Number of time steps in each window
+    :return: Indices of the windows that do not cross a time gap
+    '''
+    # Gaps between consecutive samples
+    dt = np.diff(np.ravel(time))
+    gap = dt > GAP_FACTOR * np.median(dt) if dt.size > 0 else np.zeros(0, dtype=bool)
+
+    # Window w spans the steps dt[w:w+nlags-1]; it is valid if none of them is a gap
+    cgaps = np.concatenate([[0], np.cumsum(gap)])
+    starts = np.arange(dt.size + 2 - nlags)
+    return np.nonzero(cgaps[starts + nlags - 1] == cgaps[starts])[0]
+
+
+def fold_lags(bmi, fold, nlags):
+    '''
+    Cached lag windows of one fold
+
+    :param bmi: Dictionary containing the full BMI data set
+    :param fold: Fold index
+    :param nlags: Number of time steps in each window
+    :return: Windows view and valid window indices (see lag_windows())
+    '''
+    windows = fold_cache.get(bmi, fold, ('lag_windows', nlags), lambda: valid_windows(bmi['time'][fold], nlags))
+    return window_view(bmi['MI'][fold], nlags), windows
+
+
+def fold_rows(bmi, fold, nlags):
+    '''
+    Samples of a fold that have a valid lag window (the last step of each window)
+
+    :param bmi: Dictionary containing the full BMI data set
+    :param fold: Fold index
+    :param nlags: Number of time steps in each window (None for no lags)
+    :return: Sample indices (None if nlags is None: all samples are used)
+    '''
+    if nlags is None:
+        return None
+    _, windows = fold_lags(bmi, fold, nlags)
+    return windows + nlags - 1
+
+
+def lagged_inputs(view, windows):
+    '''
+    Copy a set of windows into a standard TF input array
+
+    :param view: Windows view (see lag_windows())
+    :param windows: Window indices to copy
+    :return: Inputs (shape: windows x nlags*features)
+    '''
+    return view[windows].reshape(len(windows), -1)
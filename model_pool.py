@@ -0,0 +1,103 @@
+'''
+Pool of compiled models for running many experiments in one process
+
+Building, compiling and tracing a model is a fixed cost for every run.  The pool
+keeps each compiled model (and so its traced fit/evaluate/predict functions), keyed
+by the network builder, its arguments and its metrics (but not the learning rate,
+which is set on reset).  When a model is requested again, its weights are
+re-initialized and its optimizer and metric state are reset in place, so it behaves
+like a freshly built model.
+
+The pool owns its models: a model returned by get_model() is reset by the next
+request with the same configuration.  Callers that keep a trained model must save or
+clone it first.
+
+Author: Brandon Michaud
+'''
+import json
+import tensorflow as tf
+
+from deep_networks import fresh_initializer
+
+
+def metric_key(metric):
+    '''
+    :param metric: Keras metric
+    :return: Hashable description of the metric (its class and configuration)
+    '''
+    return (metric.__class__.__name__, json.dumps(metric.get_config(), sort_keys=True, default=str))
+
+
+def reset_model(model, lrate):
+    '''
+    Return a compiled model to its freshly built state
+
+    - Kernels and biases are drawn again from their initializers
+    - Optimizer state (iterations, moments) is zeroed and the learning rate restored
+    - Metric state is reset
+
+    :param model: Compiled model
+    :param lrate: Learning rate for the optimizer
+    '''
+    for layer in model.layers:
+        if getattr(layer, 'kernel', None) is not None:
+            # Layers such as BatchedDense provide their own kernel initialization
+            init = getattr(layer, 'initial_kernel', None) or fresh_initializer(layer.kernel_initializer)
+            layer.kernel.assign(init(layer.kernel.shape, dtype=layer.kernel.dtype))
+        if getattr(layer, 'bias', None) is not None:
+            init = fresh_initializer(layer.bias_initializer)
+            layer.bias.assign(init(layer.bias.shape, dtype=layer.bias.dtype))
+
+    # Optimizer variables are a property or a method, depending on the Keras version
+    variables = model.optimizer.variables
+    if callable(variables):
+        variables = variables()
+    for v in variables:
+        v.assign(tf.zeros_like(v))
+    model.optimizer.learning_rate = lrate
+
+    model.reset_metrics()
+
+
+class ModelPool():
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        # Key -> compiled model
+        self.models = {}
+
+    def get_model(self, builder, metrics, lrate=0.001, **kwargs):
+        '''
+        Return a compiled model, reusing a pooled one if it has the same configuration
+
+        :param builder: Network construction function (e.g., deep_network_basic)
+        :param metrics: Metrics to record after each epoch
+        :param lrate: Learning rate for Adam Optimizer
+        :param kwargs: Remaining arguments to the builder
+        :return: Compiled model with freshly initialized weights.  The model stays in the
+                pool and is reset by the next request with the same configuration
+        '''
+        # The learning rate is not part of the key: reset_model() sets it
+        key = (builder.__name__,
+               tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items())),
+               tuple(metric_key(m) for m in metrics))
+
+        if key in self.models:
+            model = self.models[key]
+            reset_model(model, lrate)
+        else:
+            model = builder(metrics=metrics, lrate=lrate, **kwargs)
+            self.models[key] = model
+
+        return model
+
+    def clear(self):
+        '''
+        Release all pooled models
+        '''
+        self.models = {}
+
+
+# Pool shared by all runs in this process
+model_pool = ModelPool()
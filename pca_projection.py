@@ -0,0 +1,154 @@
+'''
+PCA projection of the network inputs
+
+The projection for a set of training folds is computed from per-fold sufficient
+statistics (number of samples, sum of the inputs and sum of their outer products).
+The statistics of each fold are computed once (in chunks, so an array store is never
+read into memory at once) and cached in memory (see fold_cache) and, optionally, on
+disk.  The projection for any combination of folds then only needs a sum of the cached
+statistics and an eigendecomposition.
+
+The outer products grow with the square of the number of inputs (lags x features), so
+the projection is limited to MAX_INPUTS inputs.  When the statistics of the training
+folds do not fit in the memory cache (see statistics_fit_in_memory()), they must be
+cached on disk, or each run would make a new pass over the training folds.
+
+The disk cache files are named by a key of the data set file name, the fold and the
+number of lags, so one cache directory can be shared by several data sets.
+
+The projection is the first (non-trainable) layer of the network, so it is saved
+with the model and applied at inference time.
+
+Author: Brandon Michaud
+'''
+import hashlib
+import numpy as np
+import os
+
+from fold_cache import fold_cache
+from lag_features import fold_lags, lagged_inputs
+
+# Largest number of inputs for a projection (the outer products of one fold take
+# 8 * MAX_INPUTS**2 bytes: 128 MiB)
+MAX_INPUTS = 4096
+
+
+def dataset_key(bmi):
+    '''
+    :param bmi: Dictionary containing the full BMI data set (loaded with bmi_store.load_dataset())
+    :return: Short key of the data set file name
+    '''
+    assert bmi.get('fname') is not None, "The data set file name is needed to cache statistics on disk"
+    return hashlib.sha1(bmi['fname'].encode('utf-8')).hexdigest()[:12]
+
+
+def statistics_fit_in_memory(bmi, folds, nlags=None):
+    '''
+    :param bmi: Dictionary containing the full BMI data set
+    :param folds: Folds whose statistics are needed
+    :param nlags: Number of time steps in each input (None for no lags)
+    :return: True if the statistics of all of the folds fit in the memory cache at once
+    '''
+    n_inputs = bmi['MI'][folds[0]].shape[1] * (1 if nlags is None else nlags)
+    # Sum of the outer products and sum of the inputs, in float64
+    return len(folds) * 8 * n_inputs * (n_inputs + 1) <= fold_cache.max_bytes
+
+
+def fold_statistics(bmi, fold, nlags=None, cache_dir=None, chunk_size=10000):
+    '''
+    Sufficient statistics of the inputs of one fold
+
+    :param bmi: Dictionary containing the full BMI data set
+    :param fold: Fold index
+    :param nlags: Number of time steps in each input (None for no lags)
+    :param cache_dir: Directory for cached statistics (one per data set); None to only cache in memory
+    :param chunk_size: Number of rows to read at once
+    :return: N, sum of the inputs (inputs), sum of their outer products (inputs x inputs)
+    '''
+    return fold_cache.get(bmi, fold, ('pca_stats', nlags),
+                          lambda: _fold_statistics(bmi, fold, nlags, cache_dir, chunk_size))
+
+
+def _fold_statistics(bmi, fold, nlags, cache_dir, chunk_size):
+    '''
+    Compute (or read from disk) the sufficient statistics of one fold (see fold_statistics())
+    '''
+    ins = bmi['MI'][fold]
+    fname = None
+    if cache_dir is not None:
+        fname = os.path.join(cache_dir, 'pca_stats_%s_%02d%s.npz' % (dataset_key(bmi), fold,
+                                                                   '' if nlags is None else '_lags_%d' % nlags))
+
+    if fname is not None and os.path.exists(fname):
+        stats = np.load(fname)
+        N, s, ss = int(stats['N']), stats['sum'], stats['outer']
+    else:
+        if nlags is None:
+            nrows = ins.shape[0]
+            rows = lambda i: ins[i:i + chunk_size]
+        else:
+            view, windows = fold_lags(bmi, fold, nlags)
+            nrows = len(windows)
+            rows = lambda i: lagged_inputs(view, windows[i:i + chunk_size])
+
+        N = 0
+        s = 0.0
+        ss = 0.0
+        for i in range(0, nrows, chunk_size):
+            x = np.asarray(rows(i), dtype=np.float64)
+            N += x.shape[0]
+            s = s + np.sum(x, axis=0)
+            ss = ss + x.T @ x
+
+        if fname is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(fname, N=N, sum=s, outer=ss)
+
+    return N, s, ss
+
+
+def pca_projection(bmi, folds, n_components, nlags=None, cache_dir=None):
+    '''
+    PCA projection of the inputs of a set of folds
+
+    :param bmi: Dictionary containing the full BMI data set
+    :param folds: Folds whose inputs define the projection (the training folds)
+    :param n_components: Number of principal components to keep
+    :param nlags: Number of time steps in each input (None for no lags)
+    :param cache_dir: Directory for cached statistics; None to only cache in memory
+    :return: Mean of the inputs (inputs) and the principal components (inputs x n_components)
+    '''
+    n_inputs = bmi['MI'][folds[0]].shape[1] * (1 if nlags is None else nlags)
+    assert n_inputs <= MAX_INPUTS, "PCA is limited to %d inputs (%d with these lags): use fewer lags" % (MAX_INPUTS, n_inputs)
+    assert (0 < n_components <= n_inputs), "Number of components must be between 1 and the number of inputs"
+
+    # Accumulate the statistics one fold at a time
+    N = 0
+    s = 0.0
+    ss = 0.0
+    for f in folds:
+        N_fold, s_fold, ss_fold = fold_statistics(bmi, f, nlags, cache_dir)
+        N += N_fold
+        s = s + s_fold
+        ss = ss + ss_fold
+
+    mean = s / N
+    cov = ss / N - np.outer(mean, mean)
+
+    # Eigenvalues are in ascending order
+    _, vecs = np.linalg.eigh(cov)
+    components = vecs[:, ::-1][:, :n_components]
+
+    return mean, components
+
+
+def set_projection(model, mean, components):
+    '''
+    Load a projection into the model's Projection layer: x -> (x - mean) @ components
+
+    :param model: Model built with n_projection components
+    :param mean: Mean of the inputs
+    :param components: Principal components (inputs x n_components)
+    '''
+    model.get_layer('Projection').set_weights([components.astype(np.float32),
+                                               (-mean @ components).astype(np.float32)])
@@ -0,0 +1,243 @@
+'''
+Compact results files
+
+Each run is stored as:
+- <fbase>_results.json: the arguments, fold choices and scalar metrics
+- <fbase>_predict.npy: the testing predictions in float32 (uncompressed, so they can be memory mapped)
+
+The actual outputs and times of the testing set are not copied into the results; they are
+referenced through the testing folds and recovered from the (memory mapped) array store
+of the run's data set when needed (see bmi_store.open_dataset_store(), which converts a
+pickled data set once).
+
+Results written in the earlier format (<fbase>_results.pkl) are still read, and count
+as completed runs.  So are sidecars of the testing times and actual outputs
+(<fbase>_testing.npy) written by earlier versions of this module.
+
+Author: Brandon Michaud
+'''
+import argparse
+import json
+import numpy as np
+import os
+import pickle
+
+from lag_features import fold_rows
+
+
+def results_fname(fbase):
+    '''
+    :param fbase: Base file name for the run
+    :return: Name of the results header file (its existence marks a completed run)
+    '''
+    return "%s_results.json" % fbase
+
+
+def legacy_results_fname(fbase):
+    '''
+    :param fbase: Base file name for the run
+    :return: Name of the results file in the earlier (pickled) format
+    '''
+    return "%s_results.pkl" % fbase
+
+
+def results_exist(fbase):
+    '''
+    :param fbase: Base file name for the run
+    :return: True if the run has completed (in either results format)
+    '''
+    return os.path.exists(results_fname(fbase)) or os.path.exists(legacy_results_fname(fbase))
+
+
+def predict_fname(fbase):
+    '''
+    :param fbase: Base file name for the run
+    :return: Name of the testing predictions file
+    '''
+    return "%s_predict.npy" % fbase
+
+
+def save_results(fbase, args, folds, predict_testing, metrics):
+    '''
+    Write the results of one run
+
+    :param fbase: Base file name for the run
+    :param args: Argparse arguments (or a dictionary of them)
+    :param folds: Dictionary containing the lists of folds for each data set
+    :param predict_testing: Predictions for the testing set (shape: samples x outputs)
+    :param metrics: Dictionary of scalar metrics (e.g., predict_testing_fvaf)
+    '''
+    # Predictions first: the header is only written once the run is complete
+    predict_testing = np.asarray(predict_testing, dtype=np.float32)
+    np.save(predict_fname(fbase), predict_testing)
+
+    args = dict(vars(args)) if isinstance(args, argparse.Namespace) else dict(args)
+    header = {'fname_base': fbase,
+              'args': args,
+              'dataset': os.path.abspath(args['dataset']),
+              'folds': {k: [int(i) for i in v] for k, v in folds.items()},
+              'predict_file': os.path.basename(predict_fname(fbase)),
+              'predict_shape': list(predict_testing.shape)}
+    header.update({k: float(v) for k, v in metrics.items()})
+
+    with open(results_fname(fbase), "w") as fp:
+        json.dump(header, fp, indent=2)
+
+
+def load_results(fname):
+    '''
+    Read the header of one run
+
+    :param fname: Results file name (either format) or base file name
+    :return: Dictionary containing the arguments, folds and metrics
+    '''
+    if not fname.endswith('_results.json') and not fname.endswith('_results.pkl'):
+        fname = results_fname(fname) if os.path.exists(results_fname(fname)) else legacy_results_fname(fname)
+
+    if fname.endswith('.pkl'):
+        # Earlier format: the arrays are kept in the header
+        with open(fname, "rb") as fp:
+            results = pickle.load(fp)
+        header = {k: v for k, v in results.items() if k.endswith('_fvaf') or k == 'fname_base'}
+        header['args'] = dict(vars(results['args']))
+        header['legacy'] = results
+    else:
+        with open(fname, "r") as fp:
+            header = json.load(fp)
+    header['results_dir'] = os.path.dirname(fname)
+    return header
+
+
+def load_args(header):
+    '''
+    :param header: Results header
+    :return: Argparse namespace with the arguments of the run
+    '''
+    return argparse.Namespace(**header['args'])
+
+
+def load_predictions(header, mmap=True):
+    '''
+    Read the testing predictions of one run
+
+    :param header: Results header
+    :param mmap: Memory map the file instead of reading it
+    :return: Predictions (shape: samples x outputs, float32)
+    '''
+    if 'legacy' in header:
+        return header['legacy']['predict_testing']
+    fname = os.path.join(header['results_dir'], header['predict_file'])
+    return np.load(fname, mmap_mode='r' if mmap else None)
+
+
+def dataset_fname(header):
+    '''
+    :param header: Results header
+    :return: Data set of the run (pickle file name or array store directory)
+    '''
+    return header.get('dataset', header['args']['dataset'])
+
+
+def testing_folds(header):
+    '''
+    :param header: Results header
+    :return: Testing folds of the run.  Results in the earlier format do not record the folds:
+            the testing fold is rebuilt from the arguments (as in select_folds())
+    '''
+    if 'folds' in header:
+        return header['folds']['folds_testing']
+    args = header['args']
+    return [(args['Nfolds'] - 1 + args['rotation']) % args['Nfolds']]
+
+
+def needs_dataset(header):
+    '''
+    :param header: Results header
+    :return: True if the testing times and actual outputs must be resolved from the data set
+    '''
+    return 'legacy' not in header and 'testing_file' not in header
+
+
+def _testing_parts(header, bmi):
+    '''
+    The testing times and actual outputs as a list of parts, one per testing fold, without copying them
+
+    :param header: Results header
+    :param bmi: Dictionary containing the full BMI data set (only used if needs_dataset(header))
+    :return: List of (time, actual outputs, rows, output dimension).  rows selects the predicted
+            samples of the part (None for all) and the output dimension the column of the actual
+            outputs (None for all)
+    '''
+    if 'legacy' in header:
+        return [(header['legacy']['time_testing'], header['legacy']['actual_testing'], None, None)]
+
+    if 'testing_file' in header:
+        testing = np.load(os.path.join(header['results_dir'], header['testing_file']), mmap_mode='r')
+        return [(testing[:, :1], testing[:, 1:], None, None)]
+
+    assert bmi is not None, "The data set is needed to resolve the testing folds"
+    args = header['args']
+    outs = bmi[args['output_type']]
+
+    # With lag windows, only the samples with a valid window were predicted
+    return [(bmi['time'][i], outs[i], fold_rows(bmi, i, args.get('lags')), args['predict_dim'])
+            for i in testing_folds(header)]
+
+
+def _select(time, actual, rows, dim):
+    '''
+    Copy the selected samples of one part (see _testing_parts())
+    '''
+    if rows is not None:
+        time = time[rows]
+        actual = actual[rows]
+    if dim is not None:
+        actual = actual[:, [dim]]
+    return np.asarray(time), np.asarray(actual)
+
+
+def load_testing(header, bmi=None):
+    '''
+    Recover the testing set times and actual outputs that the predictions refer to
+
+    :param header: Results header
+    :param bmi: Dictionary containing the full BMI data set (only used if needs_dataset(header))
+    :return: time (samples x 1) and actual outputs (samples x outputs)
+    '''
+    parts = [_select(*part) for part in _testing_parts(header, bmi)]
+    time = np.concatenate([t for t, _ in parts], axis=0)
+    actual = np.concatenate([a for _, a in parts], axis=0)
+
+    return time, actual
+
+
+def slice_time(header, t_start, t_end, bmi=None):
+    '''
+    Select the testing samples that fall within a time range.  Only the selected
+    predictions and actual outputs are read from disk.
+
+    :param header: Results header
+    :param t_start: Start of the time range
+    :param t_end: End of the time range
+    :param bmi: Dictionary containing the full BMI data set (only used if needs_dataset(header))
+    :return: time, actual outputs and predictions within the range
+    '''
+    predict = load_predictions(header)
+
+    times = []
+    actuals = []
+    predicts = []
+    offset = 0
+    for time, actual, rows, dim in _testing_parts(header, bmi):
+        # Times are sorted within each part
+        t = np.ravel(time) if rows is None else np.ravel(time)[rows]
+        i0, i1 = np.searchsorted(t, [t_start, t_end])
+
+        r = slice(i0, i1) if rows is None else rows[i0:i1]
+        t_part, a_part = _select(time, actual, r, dim)
+        times.append(t_part)
+        actuals.append(a_part)
+        predicts.append(np.array(predict[offset + i0:offset + i1]))
+        offset += t.shape[0]
+
+    return np.concatenate(times, axis=0), np.concatenate(actuals, axis=0), np.concatenate(predicts, axis=0)
@@ -1,5 +1,7 @@
 import matplotlib.pyplot as plt
-import pickle
+
+from bmi_store import open_dataset_store
+from results_io import dataset_fname, load_results, needs_dataset, slice_time
 
 
 def make_plot():
@@ -8,13 +10,18 @@ def make_plot():
     Displays both actual and predicted
     '''
     # Open results for task 1
-    with open("results/bmi__ddtheta_1_hidden_100_10_Ntraining_18_rotation_10_results.pkl", "rb") as fp:
-        obj = pickle.load(fp)
+    header = load_results("results/bmi__ddtheta_1_hidden_100_10_Ntraining_18_rotation_10")
+
+    # Actual values and times are referenced from the (memory mapped) array store of the data set
+    bmi = open_dataset_store(dataset_fname(header)) if needs_dataset(header) else None
+
+    # Only the 7-second window is read
+    time, actual, predict = slice_time(header, 1310, 1317, bmi=bmi)
 
     # Create line plot
     fig = plt.figure()
-    plt.plot(obj['time_testing'], obj['predict_testing'], label='predicted')
-    plt.plot(obj['time_testing'], obj['actual_testing'], label='actual')
+    plt.plot(time, predict, label='predicted')
+    plt.plot(time, actual, label='actual')
     plt.xlim([1310, 1317])
     plt.ylabel('Elbow Acceleration')
     plt.xlabel('Time')
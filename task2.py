@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
+
+from results_io import load_results
 
 
 def make_plot():
@@ -20,12 +21,11 @@ def make_plot():
     # Loop over each experiment
     for r in rotations:
         for i, n in enumerate(Ntraining):
-            # Open experiment results and add them to arrays
-            with open(f'results/bmi__ddtheta_1_hidden_100_10_JI_rotation_{r}_Ntraining_{n}_results.pkl', "rb") as fp:
-                results = pickle.load(fp)
-                fvafs_training[r][i] = results['predict_training_fvaf']
-                fvafs_validation[r][i] = results['predict_validation_fvaf']
-                fvafs_testing[r][i] = results['predict_testing_fvaf']
+            # Open experiment results and add them to arrays (predictions are not read)
+            results = load_results(f'results/bmi__ddtheta_1_hidden_100_10_JI_rotation_{r}_Ntraining_{n}')
+            fvafs_training[r][i] = results['predict_training_fvaf']
+            fvafs_validation[r][i] = results['predict_validation_fvaf']
+            fvafs_testing[r][i] = results['predict_testing_fvaf']
 
     # Compute average FVAF for each training set size for each set
     avg_fvafs_training = np.average(fvafs_training, axis=0)